@@ -1,33 +1,50 @@
+import functools
 import archspec.cpu
 from shutil import which
 
+# submission commands and the scheduler they identify, in order of preference
+SCHEDULERS = (("bsub", "lsf"), ("salloc", "slurm"), ("cqsub", "cobalt"))
+
+
+@functools.lru_cache(maxsize=1)
+def _host_info():
+    """detect the host microarchitecture once, the CPU won't change under us"""
+    arch_info = archspec.cpu.host()
+    return arch_info, tuple(a.name for a in arch_info.ancestors)
+
+
+@functools.lru_cache(maxsize=1)
+def _detect_scheduler():
+    """return the first batch scheduler found on PATH, or None"""
+    for command, scheduler in SCHEDULERS:
+        if which(command):
+            return scheduler
+    return None
+
 
 def capture_tags(instance, executor_type, env=None, tag_schema=None):
     # append system architecture data gathered by archspec to tags
-    arch_info = archspec.cpu.host()
+    arch_info, ancestor_names = _host_info()
     properties = {
         "architecture": arch_info.name,
-        "micro-architecture": [],
+        "micro-architecture": list(ancestor_names),
         "custom": [],
     }
 
-    for i in arch_info.ancestors:
-        properties["micro-architecture"].append(i.name)
     # if executor is batch, gather some more system info for tags
     if executor_type == "batch":
-        if which("bsub"):
-            properties["scheduler"] = "lsf"
-        elif which("salloc"):
-            properties["scheduler"] = "slurm"
-        elif which("cqsub"):
-            properties["scheduler"] = "cobalt"
+        scheduler = _detect_scheduler()
+        if scheduler:
+            properties["scheduler"] = scheduler
     if env:
         if tag_schema:
+            os_enum = frozenset(tag_schema["properties"]["os"]["enum"])
+            arch_enum = frozenset(tag_schema["properties"]["architecture"]["enum"])
             for e in env:
                 # "tag schema" is to be applied here
-                if e in tag_schema["properties"]["os"]["enum"]:
+                if e in os_enum:
                     properties["os"] = e
-                elif e in tag_schema["properties"]["architecture"]["enum"]:
+                elif e in arch_enum:
                     properties["architecture"] = e
                 else:
                     # if we don't recognize the tag, prepend name
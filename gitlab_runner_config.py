@@ -15,6 +15,7 @@
 
 import os
 import re
+import functools
 import importlib
 import sys
 import stat
@@ -24,23 +25,34 @@ import toml
 import logging
 import gitlab
 import json
-from jsonschema import validate, ValidationError
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 from pathlib import Path
 from shutil import which
 from gitlab.exceptions import (
     GitlabAuthenticationError,
     GitlabConnectionError,
     GitlabHttpError,
+    GitlabOperationError,
 )
+from requests.adapters import HTTPAdapter, Retry
 
 HOSTNAME = socket.gethostname()
+DIGITS = re.compile(r"\d")
+CLUSTER = DIGITS.sub("", HOSTNAME)
 LOGGER_NAME = "gitlab-runner-config"
+API_WORKERS = 8
+API_PAGE_SIZE = 100
+GROUP_OTHER_PERMISSIONS = stat.S_IRWXG | stat.S_IRWXO
 logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 logger = logging.getLogger(LOGGER_NAME)
 
 
 def identifying_tags(instance):
-    identifiers = set([HOSTNAME, re.sub(r"\d", "", HOSTNAME), "managed"])
+    identifiers = set([HOSTNAME, CLUSTER, "managed"])
     if instance in identifiers:
         raise ValueError("instance name cannot be {}".format(identifiers))
     identifiers.add(instance)
@@ -48,20 +60,39 @@ def identifying_tags(instance):
 
 
 def flatten_values(d):
-    """recursively collect dictionary values into a list"""
-
-    if isinstance(d, list):
-        combined = []
-        for item in d:
-            combined += flatten_values(item)
-        return combined
-    elif isinstance(d, dict):
-        combined = []
-        for item in d.values():
-            combined += flatten_values(item)
-        return combined
-    else:
-        return [d]
+    """collect nested dictionary and list values into a flat list"""
+
+    combined = []
+    # walk depth-first with an explicit stack, pushing children in reverse so
+    # values come out in their original order
+    stack = [d]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(reversed(item))
+        elif isinstance(item, dict):
+            stack.extend(reversed(list(item.values())))
+        else:
+            combined.append(item)
+    return combined
+
+
+# compiled tag schema validators, keyed by the id of the schema they check
+_validators = {}
+
+
+def schema_validator(tag_schema):
+    """check and compile a tag schema once, reusing the validator afterwards
+
+    The validator keeps a reference to its schema, so the id used as the key
+    can't be recycled while the entry exists.
+    """
+    validator = _validators.get(id(tag_schema))
+    if validator is None:
+        cls = validator_for(tag_schema)
+        cls.check_schema(tag_schema)
+        validator = _validators[id(tag_schema)] = cls(tag_schema)
+    return validator
 
 
 def generate_tags(instance, executor_type="", env=None, tag_schema=None):
@@ -90,8 +121,11 @@ def generate_tags(instance, executor_type="", env=None, tag_schema=None):
         logger.info("Custom Tag Capture method not provided")
     try:
         if tag_schema:
-            validate(instance=properties, schema=tag_schema)
-        return flatten_values(properties)
+            error = best_match(schema_validator(tag_schema).iter_errors(properties))
+            if error is not None:
+                raise error
+        # GitLab expects a tag to appear once, drop repeats but keep the order
+        return list(dict.fromkeys(flatten_values(properties)))
     except ValidationError as e:
         logger.error(e)
         # re-raise to handle somewhere higher up. We should fail startup if we can't tag things according to the schema
@@ -107,49 +141,52 @@ class Runner:
         return len(self.executor.configs) == 0
 
     def to_dict(self):
-        config = dict(self.config)
-        config["runners"] = self.executor.configs
-        return config
+        return dict(self.config, runners=self.executor.configs)
 
 
 class Executor:
     def __init__(self, instance, configs, tag_schema=None):
         self.by_description = {}
+        self.by_url = {}
         self.instance = instance
         self.configs = configs
         self.tag_schema = tag_schema
         self.normalize()
 
     def normalize(self):
+        # executors of the same type and env tags end up with identical tags,
+        # only capture and validate them once
+        tags_by_kind = {}
+        self.by_description = {}
+        self.by_url = {}
         for c in self.configs:
             executor = c["executor"]
-            c["tags"] = generate_tags(
-                self.instance,
-                executor_type=executor,
-                env=c.get("env_tags"),
-                tag_schema=self.tag_schema,
-            )
+            env = c.get("env_tags")
+            kind = (executor, tuple(env or ()))
+            if kind not in tags_by_kind:
+                tags_by_kind[kind] = generate_tags(
+                    self.instance,
+                    executor_type=executor,
+                    env=env,
+                    tag_schema=self.tag_schema,
+                )
+            c["tags"] = list(tags_by_kind[kind])
             c["description"] = "{host} {instance} {executor} Runner".format(
                 host=HOSTNAME, instance=self.instance, executor=executor
             )
-        self.by_description = {c["description"]: c for c in self.configs}
+            self.by_description[c["description"]] = c
+            self.by_url.setdefault(c.get("url"), []).append(c)
 
     def add_token(self, executor, token):
         self.by_description[executor]["token"] = token
 
     def missing_token(self, url):
-        return [c for c in self.configs if c["url"] == url and not c.get("token")]
+        return [c for c in self.by_url.get(url, []) if not c.get("token")]
 
     def missing_required_config(self):
         def required_keys(c):
             return all(
-                [
-                    c.get("description"),
-                    c.get("token"),
-                    c.get("url"),
-                    c.get("executor"),
-                    c.get("tags"),
-                ]
+                c.get(k) for k in ("description", "token", "url", "executor", "tags")
             )
 
         return [c for c in self.configs if not required_keys(c)]
@@ -164,53 +201,95 @@ class GitLabClientManager:
         self.clients = {}
         self.registration_tokens = {}
         self.instance = instance
+        # a single pooled session, sized for the concurrent API calls and
+        # retrying failed connections, is shared by every GitLab client
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=API_WORKERS,
+            max_retries=Retry(total=3, backoff_factor=0.2),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         for client_config in client_configs:
             url = client_config["url"]
             self.registration_tokens[url] = client_config["registration_token"]
             self.clients[url] = gitlab.Gitlab(
                 url,
                 private_token=client_config["personal_access_token"],
+                session=self.session,
             )
 
+    def register(self, url, config):
+        logger.info("registering {runner}".format(runner=config["description"]))
+        return self.clients[url].runners.create(
+            {
+                "description": config["description"],
+                "token": self.registration_tokens[url],
+                "tag_list": ",".join(config["tags"]),
+                "run_untagged": False,
+            }
+        )
+
+    def sync_client(self, url, runner, tag_list):
+        """reconcile the runners registered with one GitLab against the executors
+
+        Returns the (description, token) pairs to store on the executors, the
+        executors themselves are left untouched.
+        """
+        client = self.clients[url]
+        runners = client.runners.all(
+            tag_list=tag_list, all=True, per_page=API_PAGE_SIZE
+        )
+        restorable = []
+        for r in runners:
+            if r.description in runner.executor.by_description:
+                restorable.append(r.id)
+            else:
+                # this runner's executor config was removed, it's state should
+                # be deleted from GitLab
+                logger.info(
+                    "removing {runner} runner with missing executor config".format(
+                        runner=r.description
+                    )
+                )
+                client.runners.delete(r.id)
+
+        # runner tokens are only available from the detail endpoint,
+        # fetch them concurrently rather than one round trip at a time
+        with ThreadPoolExecutor(max_workers=API_WORKERS) as pool:
+            infos = list(pool.map(client.runners.get, restorable))
+        tokens = []
+        for info in infos:
+            logger.info("restoring info for {runner}".format(runner=info.description))
+            tokens.append((info.description, info.token))
+
+        # executors missing tokens need to be registered, unless their token
+        # was just restored
+        restored = set(description for description, _ in tokens)
+        missing_token = [
+            c
+            for c in runner.executor.missing_token(url)
+            if c["description"] not in restored
+        ]
+        with ThreadPoolExecutor(max_workers=API_WORKERS) as pool:
+            infos = list(pool.map(functools.partial(self.register, url), missing_token))
+        for missing, info in zip(missing_token, infos):
+            tokens.append((missing["description"], info.token))
+        return tokens
+
     def sync_runner_state(self, runner):
+        tag_list = ",".join(identifying_tags(self.instance))
         try:
-            for url, client in self.clients.items():
-                for r in client.runners.all(
-                    tag_list=",".join(identifying_tags(self.instance))
-                ):
-                    info = client.runners.get(r.id)
-                    try:
-                        logger.info(
-                            "restoring info for {runner}".format(
-                                runner=info.description
-                            )
-                        )
-                        runner.executor.add_token(info.description, info.token)
-                    except KeyError:
-                        # this runner's executor config was removed, it's state should
-                        # be deleted from GitLab
-                        logger.info(
-                            "removing {runner} runner with missing executor config".format(
-                                runner=info.description
-                            )
-                        )
-                        client.runners.delete(r.id)
-
-                # executors missing tokens need to be registered
-                for missing in runner.executor.missing_token(url):
-                    logger.info(
-                        "registering {runner}".format(runner=missing["description"])
-                    )
-                    registration_token = self.registration_tokens[url]
-                    info = client.runners.create(
-                        {
-                            "description": missing["description"],
-                            "token": registration_token,
-                            "tag_list": ",".join(missing["tags"]),
-                            "run_untagged": False,
-                        }
-                    )
-                    runner.executor.add_token(missing["description"], info.token)
+            # GitLabs are synced concurrently, but only this thread updates the
+            # executors with the resulting tokens
+            with ThreadPoolExecutor(max_workers=max(len(self.clients), 1)) as pool:
+                futures = [
+                    pool.submit(self.sync_client, url, runner, tag_list)
+                    for url in self.clients
+                ]
+                for future in futures:
+                    for description, token in future.result():
+                        runner.executor.add_token(description, token)
         except GitlabAuthenticationError as e:
             raise SyncException(
                 "Failed authenticating to GitLab: {reason}".format(reason=e)
@@ -223,31 +302,55 @@ class GitLabClientManager:
             raise SyncException(
                 "HTTP Error communicating with GitLab: {reason}".format(reason=e)
             )
+        except GitlabOperationError as e:
+            raise SyncException("GitLab API request failed: {reason}".format(reason=e))
 
 
 def load_executors(instance, template_dir, tag_schema=None):
     executor_configs = []
-    for executor_toml in template_dir.glob("*.toml"):
-        with executor_toml.open() as et:
+    with os.scandir(template_dir) as entries:
+        # sorted so the generated config is stable from one run to the next
+        executor_tomls = sorted(
+            e.path for e in entries if e.name.endswith(".toml") and e.is_file()
+        )
+    for executor_toml in executor_tomls:
+        with open(executor_toml) as et:
             executor_configs.append(toml.load(et))
     return Executor(instance, executor_configs, tag_schema)
 
 
 def create_runner(config, instance, template_dir, tag_schema=None):
-    config_copy = dict(config)
-    del config_copy["client_configs"]
-    return Runner(config_copy, load_executors(instance, template_dir, tag_schema))
+    runner_config = {k: v for k, v in config.items() if k != "client_configs"}
+    return Runner(runner_config, load_executors(instance, template_dir, tag_schema))
 
 
 def owner_only_permissions(path):
-    st = path.stat()
-    return not (bool(st.st_mode & stat.S_IRWXG) or bool(st.st_mode & stat.S_IRWXO))
+    return not path.stat().st_mode & GROUP_OTHER_PERMISSIONS
 
 
 def secure_permissions(prefix, template_dir):
-    if not all(owner_only_permissions(d) for d in [prefix, template_dir]):
-        return False
-    return True
+    return all(owner_only_permissions(d) for d in (prefix, template_dir))
+
+
+def write_owner_only(path, text):
+    """atomically replace path with text, readable by its owner only
+
+    The text is written to a temporary sibling first, so a crash never leaves
+    behind a truncated config.
+    """
+    tmp_path = path.with_name(".{}.tmp".format(path.name))
+    fd = os.open(str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        # the mode given to os.open is ignored for a leftover temporary file
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as fh:
+            fh.write(text)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(str(tmp_path), str(path))
+    except BaseException:
+        tmp_path.unlink()
+        raise
 
 
 def generate_runner_config(prefix, instance, tag_schema=None):
@@ -286,8 +389,16 @@ def generate_runner_config(prefix, instance, tag_schema=None):
         logger.error(e)
         sys.exit(1)
 
-    logger.info("writing config to {config}".format(config=instance_config_file))
-    instance_config_file.write_text(toml.dumps(runner.to_dict()))
+    config_text = toml.dumps(runner.to_dict())
+    unchanged = instance_config_file.is_file() and (
+        instance_config_file.read_text() == config_text
+    )
+    if unchanged:
+        logger.info("{config} is up to date".format(config=instance_config_file))
+        instance_config_file.chmod(0o600)
+    else:
+        logger.info("writing config to {config}".format(config=instance_config_file))
+        write_owner_only(instance_config_file, config_text)
 
     logger.info(
         "finished configuring runner for instance {instance}".format(instance=instance)
@@ -2,11 +2,8 @@ import pytest
 import os
 import json
 import socket
-import stat
 import archspec.cpu
-from pathlib import Path
-from tempfile import TemporaryDirectory
-from capture_tags import capture_tags
+from capture_tags import capture_tags, _detect_scheduler
 from jsonschema import validate, ValidationError
 from gitlab_runner_config import flatten_values
 
@@ -22,28 +19,37 @@ def test_flatten_dict():
     assert tags == [socket.gethostname(), "batch", "instance", "1", "2", "3"]
 
 
+def test_flatten_nested():
+    properties = {"a": ["1", {"b": ["2", "3"], "c": "4"}], "d": [], "e": "5"}
+    assert flatten_values(properties) == ["1", "2", "3", "4", "5"]
+
+
+@pytest.fixture
+def scheduler_cache():
+    _detect_scheduler.cache_clear()
+    yield
+    _detect_scheduler.cache_clear()
+
+
 def test_tag_capture_no_schema():
     arch_info = archspec.cpu.host()
     properties = capture_tags("main", "batch")
     assert properties["architecture"] == arch_info.name
     assert properties["custom"] == []
-    with TemporaryDirectory() as td:
-        managers = {
-            "slurm": os.path.join(td, "salloc"),
-            "lsf": os.path.join(td, "bsub"),
-            "cobalt": os.path.join(td, "cqsub"),
-        }
 
-        os.environ["PATH"] += os.pathsep + td
 
-        def get_tags(exe):
-            Path(exe).touch()
-            os.chmod(exe, os.stat(exe).st_mode | stat.S_IEXEC)
-            tags = capture_tags("main", executor_type="batch")
-            os.unlink(exe)
-            return flatten_values(tags)
+@pytest.mark.parametrize(
+    "manager,exe_name", [("slurm", "salloc"), ("lsf", "bsub"), ("cobalt", "cqsub")]
+)
+def test_tag_capture_scheduler(
+    manager, exe_name, tmp_path, monkeypatch, scheduler_cache
+):
+    # create the executable with its mode in a single call
+    os.close(os.open(str(tmp_path / exe_name), os.O_CREAT | os.O_WRONLY, 0o755))
+    monkeypatch.setenv("PATH", os.environ["PATH"] + os.pathsep + str(tmp_path))
 
-        assert all(manager in get_tags(exe) for manager, exe in managers.items())
+    tags = flatten_values(capture_tags("main", executor_type="batch"))
+    assert manager in tags
 
 
 def test_tag_capture_schema():
@@ -60,3 +66,11 @@ def test_tag_capture_schema():
     validate(properties, schema)
     assert properties["custom"] == ["custom_mytag"]
     assert properties["os"] == "debian"
+
+
+def test_tag_capture_schema_without_custom_name():
+    with open("tag_schema.json") as fh:
+        schema = json.load(fh)
+    del schema["custom-name"]
+    properties = capture_tags("main", "batch", env=["debian"], tag_schema=schema)
+    assert properties["os"] == "debian"
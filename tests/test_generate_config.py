@@ -18,12 +18,12 @@ import toml
 import json
 import stat
 import pytest
+from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 from urllib.parse import parse_qs
 from httmock import HTTMock, urlmatch, response
+from jsonschema import ValidationError
 from pytest import fixture
-from pathlib import Path
-from tempfile import TemporaryDirectory
 from gitlab_runner_config import (
     Runner,
     Executor,
@@ -31,7 +31,9 @@ from gitlab_runner_config import (
     SyncException,
     identifying_tags,
     generate_tags,
+    schema_validator,
     owner_only_permissions,
+    write_owner_only,
     load_executors,
     create_runner,
     generate_runner_config,
@@ -50,12 +52,11 @@ def instance():
 def top_level_call_patchers():
     create_runner_patcher = patch("gitlab_runner_config.create_runner")
     client_manager_patcher = patch("gitlab_runner_config.GitLabClientManager")
-    runner = MagicMock()
-    runner.to_dict.return_value = {}
     create_runner_mock = create_runner_patcher.start()
-    create_runner_mock.return_value = runner
+    # generate_runner_config only ever serializes the runner
+    create_runner_mock.return_value = SimpleNamespace(to_dict=lambda: {})
     yield [create_runner_mock, client_manager_patcher.start()]
-    create_runner_mock.stop()
+    create_runner_patcher.stop()
     client_manager_patcher.stop()
 
 
@@ -113,13 +114,14 @@ def runner_config(client_configs):
 
 
 @fixture
-def executor_tomls_dir(executor_configs):
-    td = TemporaryDirectory()
+def executor_tomls_dir(executor_configs, tmp_path):
+    executor_dir = tmp_path / "executors"
+    executor_dir.mkdir()
     for config in executor_configs:
-        with open(td.name / Path(config["description"] + ".toml"), "w") as f:
-            toml.dump(config, f)
-    yield Path(td.name)
-    td.cleanup()
+        (executor_dir / (config["description"] + ".toml")).write_text(
+            toml.dumps(config)
+        )
+    return executor_dir
 
 
 @fixture
@@ -128,8 +130,33 @@ def executor(instance, executor_configs):
 
 
 @fixture
-def url_matchers():
-    runners = [{"id": 1}, {"id": 2}]
+def client_manager(instance, client_configs):
+    return GitLabClientManager(instance, client_configs)
+
+
+@fixture
+def requested_runners():
+    # runner ids requested from the detail and delete endpoints
+    return {"get": [], "delete": []}
+
+
+@fixture
+def url_matchers(requested_runners):
+    runners = [
+        {"id": 1, "description": "runner-1"},
+        {"id": 2, "description": "runner-2"},
+    ]
+    headers = {"content-type": "application/json"}
+    runners_content = json.dumps(runners)
+
+    def runner_content(runner_id):
+        return json.dumps(
+            {
+                "id": runner_id,
+                "token": "token",
+                "description": "runner-{}".format(runner_id),
+            }
+        )
 
     @urlmatch(path=r".*\/api\/v4\/runners/all$", method="get")
     def runner_list_resp(url, request):
@@ -139,35 +166,19 @@ def url_matchers():
         tag_list = query["tag_list"].pop().split(",")
         assert len(tag_list)
         assert len(tag_list) == len(set(tag_list))
-        headers = {"content-type": "application/json"}
-        content = json.dumps(runners)
-        return response(200, content, headers, None, 5, request)
+        return response(200, runners_content, headers, None, 5, request)
 
     @urlmatch(path=r".*\/api\/v4\/runners\/\d+$", method="get")
     def runner_detail_resp(url, request):
         runner_id = url.path.split("/")[-1]
-        headers = {"content-type": "application/json"}
-        content = json.dumps(
-            {
-                "id": runner_id,
-                "token": "token",
-                "description": "runner-{}".format(runner_id),
-            }
-        )
-        return response(200, content, headers, None, 5, request)
+        requested_runners["get"].append(int(runner_id))
+        return response(200, runner_content(runner_id), headers, None, 5, request)
 
     @urlmatch(path=r".*\/api\/v4\/runners\/\d+$", method="delete")
     def runner_delete_resp(url, request):
         runner_id = url.path.split("/")[-1]
-        headers = {"content-type": "application/json"}
-        content = json.dumps(
-            {
-                "id": runner_id,
-                "token": "token",
-                "description": "runner-{}".format(runner_id),
-            }
-        )
-        return response(204, content, headers, None, 5, request)
+        requested_runners["delete"].append(int(runner_id))
+        return response(204, runner_content(runner_id), headers, None, 5, request)
 
     @urlmatch(path=r".*\/api\/v4\/runners$", method="post")
     def runner_registration_resp(url, request):
@@ -177,16 +188,8 @@ def url_matchers():
         tag_list = body["tag_list"].split(",")
         assert len(tag_list)
         assert len(tag_list) == len(set(tag_list))
-        headers = {"content-type": "application/json"}
         # TODO id from request
-        content = json.dumps(
-            {
-                "id": 3,
-                "token": "token",
-                "description": "runner-{}".format(3),
-            }
-        )
-        return response(201, content, headers, None, 5, request)
+        return response(201, runner_content(3), headers, None, 5, request)
 
     return (
         runner_list_resp,
@@ -215,46 +218,75 @@ def test_generate_tags(instance):
     assert instance in tags
     assert hostname in tags
 
-    # test finding a resource manager
-    with TemporaryDirectory() as td:
+    # test schema runs without error
+    with open("tag_schema.json") as fh:
+        schema = json.load(fh)
+    generate_tags(instance, executor_type="batch", tag_schema=schema)
 
-        def get_tags(tag_schema=None):
-            schema = None
-            if tag_schema:
-                with open(tag_schema) as fh:
-                    schema = json.load(fh)
-            tags = generate_tags(instance, executor_type="batch", tag_schema=schema)
-            return tags
 
-        # test schema runs without error
-        get_tags(tag_schema="tag_schema.json")
+def test_schema_validator():
+    with open("tag_schema.json") as fh:
+        schema = json.load(fh)
+    assert schema_validator(schema) is schema_validator(schema)
+    with pytest.raises(ValidationError):
+        schema_validator(schema).validate({"hostname": "foo"})
 
 
-def test_generate_tags_env(instance):
+def test_generate_tags_env(instance, monkeypatch):
     env_name = "TEST_TAG"
     missing_env_name = "TEST_MISSING_TAG"
     env_val = "tag"
-    os.environ[env_name] = env_val
+    monkeypatch.setenv(env_name, env_val)
     tags = generate_tags(instance, env=[env_name, missing_env_name])
 
     assert env_val in tags
     assert missing_env_name not in tags
 
 
-def test_owner_only_permissions():
-    with TemporaryDirectory() as td:
-        d = Path(td)
-        os.chmod(d, 0o700)
-        assert owner_only_permissions(d)
+def test_generate_tags_unique(instance, monkeypatch):
+    env_name = "TEST_INSTANCE_TAG"
+    monkeypatch.setenv(env_name, instance)
+    tags = generate_tags(instance, env=[env_name])
+
+    assert tags.count(instance) == 1
+
+
+@pytest.mark.parametrize(
+    "mode,expected", [(0o700, True), (0o750, False), (0o705, False), (0o755, False)]
+)
+def test_owner_only_permissions(tmp_path, mode, expected):
+    os.chmod(tmp_path, mode)
+    assert owner_only_permissions(tmp_path) is expected
+
+
+def test_write_owner_only(tmp_path):
+    path = tmp_path / "config.toml"
+    path.write_text("old")
+    path.chmod(0o644)
+
+    write_owner_only(path, "new")
+    assert path.read_text() == "new"
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    assert os.listdir(tmp_path) == ["config.toml"]
 
-        os.chmod(d, 0o750)
-        assert not owner_only_permissions(d)
 
-        os.chmod(d, 0o705)
-        assert not owner_only_permissions(d)
+def test_write_owner_only_stale_tmp(tmp_path):
+    path = tmp_path / "config.toml"
+    stale = tmp_path / ".config.toml.tmp"
+    stale.write_text("stale")
+    stale.chmod(0o644)
 
-        os.chmod(d, 0o755)
-        assert not owner_only_permissions(d)
+    write_owner_only(path, "new")
+    assert path.read_text() == "new"
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+
+
+def test_write_owner_only_failure(tmp_path):
+    path = tmp_path / "config.toml"
+    with patch("gitlab_runner_config.os.fsync", side_effect=OSError):
+        with pytest.raises(OSError):
+            write_owner_only(path, "new")
+    assert os.listdir(tmp_path) == []
 
 
 class TestExecutor:
@@ -263,12 +295,22 @@ class TestExecutor:
         assert all(c.get("description") for c in executor.configs)
         assert all(c.get("tags") for c in executor.configs)
 
+    def test_normalize_shared_tags(self, instance, executor_configs):
+        for config in executor_configs:
+            config["executor"] = "shell"
+        with patch("gitlab_runner_config.generate_tags") as generate_tags_mock:
+            generate_tags_mock.return_value = ["shell"]
+            executor = Executor(instance, executor_configs)
+            generate_tags_mock.assert_called_once()
+        assert all(c["tags"] == ["shell"] for c in executor.configs)
+
     def test_missing_token(self, executor):
         url = executor.configs[0]["url"]
-        assert len(executor.missing_token(url)) == 1
-        for e in executor.missing_token(url):
+        missing = executor.missing_token(url)
+        assert len(missing) == 1
+        for e in missing:
             e["token"] = "token"
-        assert len(executor.missing_token(url)) == 0
+        assert not executor.missing_token(url)
 
     def test_missing_required_config(self, executor):
         assert len(executor.missing_required_config()) == len(executor.configs)
@@ -277,19 +319,28 @@ class TestExecutor:
         executor = load_executors(instance, executor_tomls_dir)
         assert len(executor.configs) == len(executor_configs)
 
-    def test_load_executors_no_files(self, instance, executor_tomls_dir):
-        with TemporaryDirectory() as td:
-            executor = load_executors(instance, Path(td))
-            assert len(executor.configs) == 0
+    def test_load_executors_no_files(self, instance, tmp_path):
+        executor = load_executors(instance, tmp_path)
+        assert len(executor.configs) == 0
 
-    def test_load_executors_extra_file(self, executor_configs, executor_tomls_dir):
-        with open(executor_tomls_dir / "bat", "w") as fh:
-            fh.write("bat")
+    def test_load_executors_extra_file(
+        self, instance, executor_configs, executor_tomls_dir
+    ):
+        (executor_tomls_dir / "bat").write_text("bat")
 
         # loaded executors should only consider .toml files
         executor = load_executors(instance, executor_tomls_dir)
         assert len(executor.configs) == len(executor_configs)
 
+    def test_load_executors_toml_dir(
+        self, instance, executor_configs, executor_tomls_dir
+    ):
+        (executor_tomls_dir / "bat.toml").mkdir()
+
+        # directories are skipped, even with a .toml suffix
+        executor = load_executors(instance, executor_tomls_dir)
+        assert len(executor.configs) == len(executor_configs)
+
 
 class TestRunner:
     def test_create(self, instance, runner_config, executor_tomls_dir):
@@ -312,28 +363,51 @@ class TestRunner:
 class TestGitLabClientManager:
     def setup_method(self, method):
         self.runner = MagicMock()
+        self.runner.executor.by_description = {"runner-1": {}, "runner-2": {}}
 
-    def test_init(self, instance, client_configs):
-        client_manager = GitLabClientManager(instance, client_configs)
+    def test_init(self, client_manager):
         assert client_manager.clients
         assert client_manager.registration_tokens
+        assert all(
+            client.session is client_manager.session
+            for client in client_manager.clients.values()
+        )
 
-    def test_sync_runner_state(self, instance, client_configs, url_matchers):
-        client_manager = GitLabClientManager(instance, client_configs)
-
+    def test_sync_runner_state(self, client_manager, url_matchers):
         with HTTMock(*url_matchers):
             client_manager.sync_runner_state(self.runner)
             self.runner.executor.add_token.assert_called()
 
-    def test_sync_runner_state_delete(self, instance, client_configs, url_matchers):
-        client_manager = GitLabClientManager(instance, client_configs)
-        self.runner.executor.add_token.side_effect = KeyError("Missing key!")
+    def test_sync_client(self, client_manager, client_configs, url_matchers):
+        url = client_configs[0]["url"]
+        with HTTMock(*url_matchers):
+            tokens = client_manager.sync_client(url, self.runner, "tag")
+        assert tokens == [("runner-1", "token"), ("runner-2", "token")]
+        self.runner.executor.add_token.assert_not_called()
+
+    def test_sync_runner_state_delete(
+        self, client_manager, client_configs, url_matchers, requested_runners
+    ):
+        self.runner.executor.by_description = {"runner-1": {}}
         with HTTMock(*url_matchers):
             client_manager.sync_runner_state(self.runner)
-            self.runner.executor.add_token.assert_called()
+        # only runner-2 lacks an executor config, once per GitLab
+        assert requested_runners["delete"] == [2] * len(client_configs)
+        # only runner-1 needs its details fetched to restore the token
+        assert requested_runners["get"] == [1] * len(client_configs)
+        self.runner.executor.add_token.assert_called_with("runner-1", "token")
+
+    def test_sync_runner_state_api_error(self, client_manager):
+        @urlmatch(path=r".*\/api\/v4\/runners/all$", method="get")
+        def runner_list_error(url, request):
+            return response(500, "{}", None, None, 5, request)
+
+        with HTTMock(runner_list_error), pytest.raises(SyncException):
+            client_manager.sync_runner_state(self.runner)
 
-    def test_sync_runner_state_missing(self, instance, client_configs, url_matchers):
-        client_manager = GitLabClientManager(instance, client_configs)
+    def test_sync_runner_state_missing(
+        self, client_manager, client_configs, url_matchers
+    ):
         self.runner.executor.missing_token.return_value = [
             {"description": "bat", "tags": ["bat", "bam"]}
         ]
@@ -350,6 +424,19 @@ class TestGitLabRunnerConfig:
     def test_generate_runner_config(self, established_prefix, top_level_call_patchers):
         generate_runner_config(*established_prefix)
 
+    def test_generate_runner_config_unchanged(
+        self, established_prefix, top_level_call_patchers
+    ):
+        prefix, instance = established_prefix
+        instance_config_file = prefix / "config.{}.toml".format(instance)
+        instance_config_file.write_text(toml.dumps({}))
+        instance_config_file.chmod(0o644)
+        os.utime(instance_config_file, (0, 0))
+
+        generate_runner_config(prefix, instance)
+        assert instance_config_file.stat().st_mtime == 0
+        assert stat.S_IMODE(instance_config_file.stat().st_mode) == 0o600
+
     def test_generate_runner_config_invalid_prefix_perms(
         self, established_prefix, top_level_call_patchers
     ):